@@ -4,8 +4,6 @@ import os
 import sys
 import warnings
 import re
-from sklearn.preprocessing import StandardScaler
-from sklearn.metrics.pairwise import cosine_similarity
 
 # --- CONFIGURATION ---
 n_mfcc_features = 5
@@ -13,6 +11,14 @@ n_mfcc_features = 5
 MFCC_WEIGHT = 0.4
 CHROMA_WEIGHT = 0.2
 TEMPO_WEIGHT = 0.4
+# Processed features are cached next to the CSV and reused while the CSV is unchanged
+CACHE_SUFFIX = '.cache.npz'
+CACHE_VERSION = 4
+FEATURE_KEYS = ['filenames', 'normalized', 'vocab', 'word_ids', 'word_rows', 'mfcc_start_n', 'mfcc_end_n',
+                'chroma_start_n', 'chroma_end_n', 'tempo_start', 'tempo_end']
+
+# Set SMARTMIX_DEBUG=1 to log matching and scoring details to stderr
+DEBUG = os.environ.get('SMARTMIX_DEBUG') == '1'
 
 # Suppress warnings
 warnings.filterwarnings("ignore", category=UserWarning)
@@ -20,76 +26,143 @@ warnings.filterwarnings("ignore", category=SyntaxWarning)
 
 # --- HELPER FUNCTIONS ---
 
+# Precompiled patterns for song-name normalization
+_PAREN_RE = re.compile(r'[\(\[].*?[\)\]]')
+_SPECIAL_RE = re.compile(r'[^\w\s]')
+_WS_RE = re.compile(r'\s+')
+# Deletion table covering every ASCII character _SPECIAL_RE would strip
+_PUNCT_TBL = {c: None for c in range(128) if _SPECIAL_RE.match(chr(c))}
+
 def normalize_song_name(name):
     """Normalize song name for better matching"""
     if not isinstance(name, str):
         return ""
     # Remove content in parentheses, brackets, special characters, and extra spaces
-    name = re.sub(r'[\(\[].*?[\)\]]', '', name)  # Remove content in parentheses/brackets
-    name = re.sub(r'[^\w\s]', '', name)  # Remove special characters
-    name = name.lower().strip()  # Convert to lowercase and trim
-    name = re.sub(r'\s+', ' ', name)  # Replace multiple spaces with single space
+    name = _PAREN_RE.sub('', name)  # Remove content in parentheses/brackets
+    name = name.translate(_PUNCT_TBL)  # Remove special characters
+    if not name.isascii():
+        name = _SPECIAL_RE.sub('', name)  # Unicode punctuation needs the full pattern
+    name = _WS_RE.sub(' ', name.lower().strip())  # Lowercase, trim and collapse spaces
     return name
 
-def find_best_crossfade_from_match(target_song_name, df, similarity_matrix):
+def parse_feature_column(series):
+    """Parse a column of comma-separated feature strings into a 2-D float32 array"""
+    # Single precision is plenty for these low-dimensional audio features
+    return np.array(series.str.strip('[]').str.split(',').tolist(), dtype=np.float32)
+
+def find_target_index(target_song_name, norm_array, word_index, filename_arr, name_to_idx):
     """
-    Finds and returns the best song name to crossfade INTO from a target song.
+    Finds the row index of the CSV song that best matches the target song name.
     Returns None if no suitable match is found.
     """
-    try:
+    if DEBUG:
         print(f"DEBUG: Searching for target song: '{target_song_name}'", file=sys.stderr)
-        
-        # Normalize the target song name
-        normalized_target = normalize_song_name(target_song_name)
+    
+    # Normalize the target song name
+    normalized_target = normalize_song_name(target_song_name)
+    if DEBUG:
         print(f"DEBUG: Normalized target: '{normalized_target}'", file=sys.stderr)
-        
-        # Get all normalized song names from CSV
-        df_normalized = df['filename'].apply(normalize_song_name)
-        print(f"DEBUG: First 10 normalized CSV songs: {df_normalized.head(10).tolist()}", file=sys.stderr)
-        
-        # Try to find the best match
-        best_match_idx = -1
-        best_match_score = 0
-        
-        for idx, csv_song_normalized in enumerate(df_normalized):
-            # Calculate similarity score (simple string matching)
-            if normalized_target in csv_song_normalized or csv_song_normalized in normalized_target:
-                score = 1.0
-            else:
-                # Use sequence matching for partial matches
-                target_words = set(normalized_target.split())
-                csv_words = set(csv_song_normalized.split())
-                common_words = target_words.intersection(csv_words)
-                score = len(common_words) / max(len(target_words), 1)
-            
-            if score > best_match_score:
-                best_match_score = score
-                best_match_idx = idx
-        
-        if best_match_idx == -1 or best_match_score < 0.3:
-            print(f"ERROR: No suitable match found for '{target_song_name}' (best score: {best_match_score})", file=sys.stderr)
-            return None
-        
+    
+    # Normalized names and the word index are precomputed once per CSV
+    if DEBUG:
+        print(f"DEBUG: First 10 normalized CSV songs: {norm_array[:10].tolist()}", file=sys.stderr)
+    
+    # Try to find the best match
+    best_match_idx = -1
+    best_match_score = 0
+    
+    if normalized_target in name_to_idx:
+        # Exact name match, no need to scan every row. This takes precedence over
+        # earlier rows that would also score 1.0 through substring or word overlap
+        best_match_idx = name_to_idx[normalized_target]
+        best_match_score = 1.0
+    else:
+        # Substring match in either direction counts as a perfect score
+        substring_mask = (np.char.find(norm_array, normalized_target) >= 0) | \
+                         (np.char.find(normalized_target, norm_array) >= 0)
+        # Otherwise score by word overlap, counting shared words for every
+        # song at once from the (word id, row) pairs
+        vocab, word_ids, word_rows = word_index
+        target_set = set(normalized_target.split())
+        target_ids = [vocab[w] for w in target_set if w in vocab]
+        common = np.bincount(word_rows[np.isin(word_ids, target_ids)], minlength=len(norm_array))
+        # One score vector, so argmax keeps the first row with the highest score
+        # whether it scored 1.0 through a substring or through full word overlap
+        scores = np.where(substring_mask, 1.0, common / max(len(target_set), 1))
+        if len(scores):
+            best_match_idx = int(np.argmax(scores))
+            best_match_score = float(scores[best_match_idx])
+    
+    if best_match_idx == -1 or best_match_score < 0.3:
+        print(f"ERROR: No suitable match found for '{target_song_name}' (best score: {best_match_score})", file=sys.stderr)
+        return None
+    
+    if DEBUG:
         print(f"DEBUG: Best match found at index {best_match_idx} with score {best_match_score}", file=sys.stderr)
-        print(f"DEBUG: Original CSV name: '{df.iloc[best_match_idx]['filename']}'", file=sys.stderr)
-        
-        target_song_idx = best_match_idx
-        similarities = similarity_matrix[target_song_idx, :]
-        
-        # Get top 5 matches for debugging
-        similar_indices = similarities.argsort()[::-1]
-        print(f"DEBUG: Top 5 similar songs:", file=sys.stderr)
-        for i, idx in enumerate(similar_indices[:5]):
-            if idx != target_song_idx:
-                similarity_score = similarities[idx]
-                print(f"  {i+1}. '{df.iloc[idx]['filename']}' - score: {similarity_score:.4f}", file=sys.stderr)
+        print(f"DEBUG: Original CSV name: '{filename_arr[best_match_idx]}'", file=sys.stderr)
+    return best_match_idx
+
+def build_word_index(norm_array):
+    """
+    Builds a bag-of-words index over normalized song names: the vocabulary plus
+    parallel arrays of (word id, row) pairs, one pair per distinct word in a row.
+    """
+    vocab = {}
+    word_ids, word_rows = [], []
+    for row, name in enumerate(norm_array):
+        for word in set(name.split()):
+            word_ids.append(vocab.setdefault(word, len(vocab)))
+            word_rows.append(row)
+    return np.array(list(vocab), dtype=str), np.array(word_ids, dtype=np.int32), np.array(word_rows, dtype=np.int32)
+
+def standardize_pair(start_matrix, end_matrix):
+    """
+    Standardizes start and end features of the same type using shared statistics,
+    so that start/end vectors live in the same space when compared.
+    """
+    # Pooled statistics from per-matrix sums, without stacking both into a copy
+    n = len(start_matrix) + len(end_matrix)
+    mu = (start_matrix.sum(axis=0) + end_matrix.sum(axis=0)) / n
+    start_scaled = start_matrix - mu
+    end_scaled = end_matrix - mu
+    variance = (np.square(start_scaled).sum(axis=0) + np.square(end_scaled).sum(axis=0)) / n
+    sigma = np.sqrt(variance) + 1e-8  # Avoid division by zero for constant features
+    start_scaled /= sigma
+    end_scaled /= sigma
+    return start_scaled, end_scaled
+
+def l2_normalize_rows(matrix):
+    """Scale each row to unit length so cosine similarity becomes a dot product"""
+    row_norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(row_norms == 0, 1, row_norms)  # Zero rows stay zero
+
+def find_best_crossfade_from_match(target_song_idx, filename_arr, similarities):
+    """
+    Finds and returns the best song name to crossfade INTO from the target song,
+    given the target's row of the similarity matrix.
+    Returns None if no suitable match is found.
+    """
+    try:
+        if DEBUG:
+            # Get top 5 matches for debugging; only the top few entries need sorting
+            k = min(6, len(similarities))
+            top = np.argpartition(-similarities, k - 1)[:k]
+            similar_indices = top[np.argsort(-similarities[top])]
+            print(f"DEBUG: Top 5 similar songs:", file=sys.stderr)
+            for i, idx in enumerate(similar_indices[:5]):
+                if idx != target_song_idx:
+                    similarity_score = similarities[idx]
+                    print(f"  {i+1}. '{filename_arr[idx]}' - score: {similarity_score:.4f}", file=sys.stderr)
 
         # Find the top match that is not the song itself
-        for idx in similar_indices:
-            if idx != target_song_idx:
-                match_filename = df.iloc[idx]['filename']
+        if len(similarities) > 1:
+            candidates = similarities.copy()
+            candidates[target_song_idx] = -np.inf
+            best_idx = int(candidates.argmax())
+            match_filename = filename_arr[best_idx]
+            if DEBUG:
                 print(f"DEBUG: Selected match: '{match_filename}'", file=sys.stderr)
-                return match_filename
+            return match_filename
 
         print("ERROR: No suitable match found (only self-match available)", file=sys.stderr)
         return None
@@ -100,80 +173,196 @@ def find_best_crossfade_from_match(target_song_name, df, similarity_matrix):
         traceback.print_exc(file=sys.stderr)
         return None
 
+def build_features(input_csv_file):
+    """
+    Loads the CSV and turns it into the arrays the recommendation step needs:
+    filenames, normalized names, unit-length scaled MFCC/chroma rows and tempos.
+    """
+    # Only the feature columns are needed; skip parsing anything else (e.g. uri)
+    required_columns = ['filename', 'mfcc_start', 'chroma_start', 'mfcc_end', 'chroma_end', 'tempo_start', 'tempo_end']
+    df_final = pd.read_csv(input_csv_file, usecols=lambda col: col in required_columns,
+                           dtype={'tempo_start': np.float32, 'tempo_end': np.float32})
+    if DEBUG:
+        print(f"DEBUG: Loaded CSV with {len(df_final)} rows", file=sys.stderr)
+    
+    # Check if required columns exist
+    missing_columns = [col for col in required_columns if col not in df_final.columns]
+    if missing_columns:
+        print(f"ERROR: Missing columns in CSV: {missing_columns}", file=sys.stderr)
+        sys.exit(1)
+        
+    # Convert stringified features straight into 2-D feature matrices
+    mfcc_start_matrix = parse_feature_column(df_final['mfcc_start'])
+    chroma_start_matrix = parse_feature_column(df_final['chroma_start'])
+    mfcc_end_matrix = parse_feature_column(df_final['mfcc_end'])
+    chroma_end_matrix = parse_feature_column(df_final['chroma_end'])
+    if DEBUG:
+        print("DEBUG: Successfully parsed feature columns", file=sys.stderr)
+
+    mfcc_start_scaled, mfcc_end_scaled = standardize_pair(mfcc_start_matrix, mfcc_end_matrix)
+    chroma_start_scaled, chroma_end_scaled = standardize_pair(chroma_start_matrix, chroma_end_matrix)
+
+    normalized = np.array([normalize_song_name(n) for n in df_final['filename']], dtype=str)
+    vocab, word_ids, word_rows = build_word_index(normalized)
+
+    return {
+        'filenames': df_final['filename'].to_numpy(dtype=str),
+        'normalized': normalized,
+        'vocab': vocab,
+        'word_ids': word_ids,
+        'word_rows': word_rows,
+        # Normalize once so cosine similarity reduces to a plain dot product
+        'mfcc_start_n': l2_normalize_rows(mfcc_start_scaled),
+        'mfcc_end_n': l2_normalize_rows(mfcc_end_scaled),
+        'chroma_start_n': l2_normalize_rows(chroma_start_scaled),
+        'chroma_end_n': l2_normalize_rows(chroma_end_scaled),
+        'tempo_start': df_final['tempo_start'].to_numpy(np.float32),
+        'tempo_end': df_final['tempo_end'].to_numpy(np.float32),
+    }
+
+def load_feature_cache(cache_path, csv_mtime):
+    """
+    Returns the cached feature arrays if the cache was built from the current CSV.
+    Returns None if there is no usable cache.
+    """
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with np.load(cache_path) as data:
+            if int(data['cache_version']) != CACHE_VERSION or float(data['csv_mtime']) != csv_mtime:
+                if DEBUG:
+                    print("DEBUG: Feature cache is stale, rebuilding", file=sys.stderr)
+                return None
+            return {key: data[key] for key in FEATURE_KEYS}
+    except Exception as e:
+        if DEBUG:
+            print(f"DEBUG: Could not read feature cache: {e}", file=sys.stderr)
+        return None
+
+def save_feature_cache(cache_path, csv_mtime, features):
+    """Writes the feature arrays next to the CSV; failures only cost the next run a rebuild"""
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, cache_version=CACHE_VERSION, csv_mtime=csv_mtime, **features)
+        os.replace(tmp_path, cache_path)  # Atomic, so concurrent runs never see a partial file
+        if DEBUG:
+            print(f"DEBUG: Wrote feature cache '{cache_path}'", file=sys.stderr)
+    except OSError as e:
+        # e.g. read-only deployments; the engine still works without the cache
+        if DEBUG:
+            print(f"DEBUG: Could not write feature cache: {e}", file=sys.stderr)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def compute_similarity_rows(features, target_indices):
+    """
+    Computes the rows of the crossfade similarity matrix for the given target songs.
+    Returns a (len(target_indices), N) float32 array.
+    """
+    mfcc_start_n = features['mfcc_start_n']
+    mfcc_end_n = features['mfcc_end_n']
+    chroma_start_n = features['chroma_start_n']
+    chroma_end_n = features['chroma_end_n']
+
+    # Tempo similarity is normalized by the largest tempo gap over all song pairs
+    tempo_start = features['tempo_start']
+    tempo_end = features['tempo_end']
+    tempo_max = max(tempo_end.max() - tempo_start.min(), tempo_start.max() - tempo_end.min())
+
+    # Accumulate the weighted similarity rows in place, reusing one scratch buffer
+    similarities = np.empty((len(target_indices), len(tempo_start)), dtype=np.float32)
+    scratch = np.empty_like(similarities)
+    np.matmul(mfcc_end_n[target_indices], mfcc_start_n.T, out=similarities)
+    similarities *= MFCC_WEIGHT
+    np.matmul(chroma_end_n[target_indices], chroma_start_n.T, out=scratch)
+    scratch *= CHROMA_WEIGHT
+    similarities += scratch
+    # TEMPO_WEIGHT * (1 - gap / max) folded into a constant plus one scaled subtraction
+    np.subtract(tempo_end[target_indices, None], tempo_start, out=scratch)
+    np.abs(scratch, out=scratch)
+    scratch *= TEMPO_WEIGHT / (tempo_max + 1e-8)  # Avoid division by zero
+    similarities += TEMPO_WEIGHT
+    similarities -= scratch
+    return similarities
+
 # --- MAIN RECOMMENDATION LOGIC ---
 
 def main():
     """Main function to load data and run the recommendation engine."""
     
-    # Check for both song name and CSV file path arguments
-    if len(sys.argv) < 3:
-        print("Usage: python recommendation_engine.py <song_name> <csv_file_path>", file=sys.stderr)
-        sys.exit(1)
+    usage = ("Usage: python recommendation_engine.py <song_name> <csv_file_path>\n"
+             "       python recommendation_engine.py --targets <targets_file> <csv_file_path>")
 
-    target_song_name = sys.argv[1]
-    input_csv_file = sys.argv[2]
+    # "--targets FILE" reads one target song name per line, for batch recommendations.
+    # Otherwise the first argument is always taken literally as a single song name.
+    if len(sys.argv) >= 2 and sys.argv[1] == '--targets':
+        if len(sys.argv) < 4:
+            print(usage, file=sys.stderr)
+            sys.exit(1)
+        targets_file = sys.argv[2]
+        input_csv_file = sys.argv[3]
+        if not os.path.exists(targets_file):
+            print(f"ERROR: The file '{targets_file}' does not exist.", file=sys.stderr)
+            sys.exit(1)
+        with open(targets_file, encoding='utf-8') as f:
+            target_song_names = [line.strip() for line in f if line.strip()]
+    else:
+        # Check for both song name and CSV file path arguments
+        if len(sys.argv) < 3:
+            print(usage, file=sys.stderr)
+            sys.exit(1)
+        target_song_names = [sys.argv[1]]
+        input_csv_file = sys.argv[2]
 
-    print(f"DEBUG: Starting recommendation for '{target_song_name}'", file=sys.stderr)
-    print(f"DEBUG: CSV file path: '{input_csv_file}'", file=sys.stderr)
+    if DEBUG:
+        print(f"DEBUG: Starting recommendation for {target_song_names}", file=sys.stderr)
+        print(f"DEBUG: CSV file path: '{input_csv_file}'", file=sys.stderr)
 
     # Load data
     if not os.path.exists(input_csv_file):
         print(f"ERROR: The file '{input_csv_file}' does not exist.", file=sys.stderr)
         sys.exit(1)
 
-    try:
-        df_final = pd.read_csv(input_csv_file)
-        print(f"DEBUG: Loaded CSV with {len(df_final)} rows", file=sys.stderr)
-        
-        # Check if required columns exist
-        required_columns = ['filename', 'mfcc_start', 'chroma_start', 'mfcc_end', 'chroma_end', 'tempo_start', 'tempo_end']
-        missing_columns = [col for col in required_columns if col not in df_final.columns]
-        if missing_columns:
-            print(f"ERROR: Missing columns in CSV: {missing_columns}", file=sys.stderr)
+    cache_path = input_csv_file + CACHE_SUFFIX
+    csv_mtime = os.path.getmtime(input_csv_file)
+    features = load_feature_cache(cache_path, csv_mtime)
+    if features is not None:
+        if DEBUG:
+            print(f"DEBUG: Loaded features from cache '{cache_path}'", file=sys.stderr)
+    else:
+        try:
+            features = build_features(input_csv_file)
+        except Exception as e:
+            print(f"ERROR loading or parsing the CSV file: {e}", file=sys.stderr)
+            import traceback
+            traceback.print_exc(file=sys.stderr)
             sys.exit(1)
-            
-        # Convert stringified features back to numpy arrays/floats
-        df_final['mfcc_start'] = df_final['mfcc_start'].apply(lambda x: np.array([float(val) for val in x.strip('[]').split(',')]))
-        df_final['chroma_start'] = df_final['chroma_start'].apply(lambda x: np.array([float(val) for val in x.strip('[]').split(',')]))
-        df_final['mfcc_end'] = df_final['mfcc_end'].apply(lambda x: np.array([float(val) for val in x.strip('[]').split(',')]))
-        df_final['chroma_end'] = df_final['chroma_end'].apply(lambda x: np.array([float(val) for val in x.strip('[]').split(',')]))
-        
-        print("DEBUG: Successfully parsed feature columns", file=sys.stderr)
+        save_feature_cache(cache_path, csv_mtime, features)
 
-    except Exception as e:
-        print(f"ERROR loading or parsing the CSV file: {e}", file=sys.stderr)
-        import traceback
-        traceback.print_exc(file=sys.stderr)
+    # Rebuild the lookups for song-name matching from the cached arrays
+    filename_arr = features['filenames']
+    norm_array = features['normalized']
+    vocab = {w: i for i, w in enumerate(features['vocab'])}
+    word_index = (vocab, features['word_ids'], features['word_rows'])
+    # The first occurrence wins for duplicate names
+    name_to_idx = {}
+    for i, n in enumerate(norm_array):
+        name_to_idx.setdefault(n, i)
+
+    # Locate the target songs before doing any similarity work
+    target_indices = [find_target_index(name, norm_array, word_index, filename_arr, name_to_idx)
+                      for name in target_song_names]
+    found_indices = [idx for idx in target_indices if idx is not None]
+    if not found_indices:
+        print("ERROR: Recommendation engine could not find a suitable song name.", file=sys.stderr)
         sys.exit(1)
 
-    # Reshape features and scale them
+    # Compute only the targets' rows of the similarity matrix, as one batch
     try:
-        mfcc_start_matrix = np.vstack(df_final['mfcc_start'].values)
-        mfcc_end_matrix = np.vstack(df_final['mfcc_end'].values)
-        chroma_start_matrix = np.vstack(df_final['chroma_start'].values)
-        chroma_end_matrix = np.vstack(df_final['chroma_end'].values)
-
-        scaler = StandardScaler()
-        mfcc_start_scaled = scaler.fit_transform(mfcc_start_matrix)
-        mfcc_end_scaled = scaler.fit_transform(mfcc_end_matrix)
-        chroma_start_scaled = scaler.fit_transform(chroma_start_matrix)
-        chroma_end_scaled = scaler.fit_transform(chroma_end_matrix)
-
-        # Calculate individual similarity matrices
-        mfcc_similarity = cosine_similarity(mfcc_end_scaled, mfcc_start_scaled)
-        chroma_similarity = cosine_similarity(chroma_end_scaled, chroma_start_scaled)
-
-        # Calculate tempo similarity
-        df_tempo = df_final[['tempo_start', 'tempo_end']].copy()
-        tempo_matrix = np.abs(df_tempo.values[:, 1].reshape(-1, 1) - df_tempo.values[:, 0].reshape(1, -1))
-        tempo_similarity = 1 - (tempo_matrix / (tempo_matrix.max() + 1e-8))  # Avoid division by zero
-
-        # Combine matrices using weights
-        similarity_matrix = (MFCC_WEIGHT * mfcc_similarity) + \
-                            (CHROMA_WEIGHT * chroma_similarity) + \
-                            (TEMPO_WEIGHT * tempo_similarity)
-
-        print("DEBUG: Successfully calculated similarity matrix", file=sys.stderr)
+        similarity_rows = compute_similarity_rows(features, found_indices)
+        if DEBUG:
+            print(f"DEBUG: Successfully calculated {len(found_indices)} similarity row(s)", file=sys.stderr)
 
     except Exception as e:
         print(f"ERROR in feature processing: {e}", file=sys.stderr)
@@ -181,14 +370,21 @@ def main():
         traceback.print_exc(file=sys.stderr)
         sys.exit(1)
 
-    # Find and print the best recommendation to standard output (stdout)
-    recommended_song_name = find_best_crossfade_from_match(target_song_name, df_final, similarity_matrix)
-    if recommended_song_name:
-        print(recommended_song_name)
-    else:
+    # Find and print the best recommendations to standard output (stdout), one line per target
+    recommended_song_names = []
+    rows = iter(similarity_rows)
+    for target_song_idx in target_indices:
+        if target_song_idx is None:
+            recommended_song_names.append(None)
+        else:
+            recommended_song_names.append(find_best_crossfade_from_match(target_song_idx, filename_arr, next(rows)))
+
+    if not any(recommended_song_names):
         print("ERROR: Recommendation engine could not find a suitable song name.", file=sys.stderr)
         sys.exit(1)
-
+    for recommended_song_name in recommended_song_names:
+        # Batch output keeps an empty line for targets without a recommendation
+        print(recommended_song_name or '')
 
 if __name__ == "__main__":
     main()
\ No newline at end of file